@@ -20,21 +20,36 @@ import sys
 sys.path.append(os.path.join(os.path.dirname(__file__), "tests"))
 
 from utils.fixtures import *
+from utils.common import (
+    create_bitbake_variables_cache_dir,
+    remove_bitbake_variables_cache_dir,
+)
+
+
+def pytest_configure(config):
+    # Only the controller, before it starts any xdist workers.
+    if not hasattr(config, "workerinput"):
+        create_bitbake_variables_cache_dir()
+
+
+def pytest_unconfigure(config):
+    if not hasattr(config, "workerinput"):
+        remove_bitbake_variables_cache_dir()
 
 
 def pytest_collection_modifyitems(session, config, items):
     # This reordering is done for exclusive tests: Those that are not run in
-    # parallel. We use flock to obtain shared and exclusive locks. Unfortunately
-    # flock is dumb: If an exclusive lock is waiting to be obtained, it will
-    # keep granting shared locks as long as at least one worker has one. To get
-    # the exclusive lock, all workers would have to release their shared locks
-    # at the same time, which will virtually never happen. This means that each
-    # exclusive test would tie up one worker waiting for this, defeating the
-    # purpose of parallelism.
+    # parallel. We use flock to obtain shared and exclusive locks. Every worker
+    # holds a shared lock on its own lock file while running a normal test, and
+    # an exclusive test takes exclusive locks on the lock files of all workers,
+    # one by one (see the `exclusivity` fixture). This means that an exclusive
+    # test ties up its own worker until every other worker has finished its
+    # current test, and meanwhile keeps the workers it has already locked idle.
+    # Doing this in the middle of the run would stall the parallel work over
+    # and over.
     #
     # To deal with this, move all exclusive tests to the end of the queue, so
-    # that when we finally get to them, we already know that no more shared
-    # locks will be granted.
+    # that they only hold up the workers once the parallel work is mostly done.
     i = 0
     end = len(items)
     while i < end:
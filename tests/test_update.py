@@ -28,6 +28,7 @@ from utils.common import (
     determine_active_passive_part,
     get_no_sftp,
     make_tempdir,
+    probe_device_state,
     put_no_sftp,
     reboot,
     run_after_connect,
@@ -246,7 +247,7 @@ class TestUpdates:
         mender_update_binary,
     ):
 
-        (active_before, passive_before) = determine_active_passive_part(
+        (active_before, passive_before), (bootenv_print, _) = probe_device_state(
             bitbake_variables, connection
         )
 
@@ -260,8 +261,6 @@ class TestUpdates:
             s3_address,
         )
 
-        bootenv_print, _ = bootenv_tools(connection)
-
         output = connection.run(f"{bootenv_print} bootcount").stdout
         assert output.rstrip("\n") == "bootcount=0"
 
@@ -797,11 +796,13 @@ class TestUpdates:
                 finally:
                     # Reset environment to what it was.
                     _, bootenv_set = bootenv_tools(connection)
-                    connection.run(f"{bootenv_set} mender_boot_part %s" % active[-1:])
-                    connection.run(
-                        f"{bootenv_set} mender_boot_part_hex %x" % int(active[-1:])
+                    connection.run_many(
+                        [
+                            f"{bootenv_set} mender_boot_part %s" % active[-1:],
+                            f"{bootenv_set} mender_boot_part_hex %x" % int(active[-1:]),
+                            f"{bootenv_set} upgrade_available 0",
+                        ]
                     )
-                    connection.run(f"{bootenv_set} upgrade_available 0")
                     if device_has_mender_conf:
                         connection.run(
                             "cp -L /data/etc/mender/mender.conf.bak $(realpath /etc/mender/mender.conf)"
@@ -1105,9 +1106,9 @@ class TestUpdates:
 
         """
 
-        (active_before, passive_before) = determine_active_passive_part(
-            bitbake_variables, connection
-        )
+        partitions, bootenv = probe_device_state(bitbake_variables, connection)
+        (active_before, passive_before) = partitions
+        bootenv_print, bootenv_set = bootenv
 
         Helpers.install_update(
             successful_image_update_mender,
@@ -1119,8 +1120,6 @@ class TestUpdates:
             s3_address,
         )
 
-        bootenv_print, bootenv_set = bootenv_tools(connection)
-
         output = connection.run(f"{bootenv_print} upgrade_available").stdout
         assert output.rstrip("\n") == "upgrade_available=1"
 
@@ -1160,12 +1159,12 @@ class TestUpdates:
         # This is just a time saving measure when cleaning up. Since we rolled back, but didn't
         # reboot, the boot environment doesn't match the mounted root now. But the update we did is
         # perfectly valid, so instead of wasting time on another reboot, just switch to this rootfs.
-        output = connection.run(
-            f"{bootenv_set} mender_boot_part {passive_before[-1:]}"
-        ).stdout
-        output = connection.run(
-            f"{bootenv_set} mender_boot_part_hex {passive_before[-1:]}"
-        ).stdout
+        connection.run_many(
+            [
+                f"{bootenv_set} mender_boot_part {passive_before[-1:]}",
+                f"{bootenv_set} mender_boot_part_hex {passive_before[-1:]}",
+            ]
+        )
 
         output = connection.run(f"{bootenv_print} mender_boot_part").stdout
         assert output.rstrip("\n") == "mender_boot_part=" + passive_before[-1:]
@@ -16,9 +16,15 @@
 import packaging.version
 import fcntl
 import filelock
+import fnmatch
+import functools
+import glob
+import hashlib
+import json
 import pytest
 import os
 import re
+import socket
 import subprocess
 import time
 import tempfile
@@ -36,6 +42,11 @@ class Result:
         self.return_code = exited
 
 
+def _print_output(stdout, stderr):
+    # Same as printing both, but in a single write.
+    sys.stdout.write("%s\n%s\n" % (stdout, stderr))
+
+
 class Connection:
     def __init__(self, host, user, port, connect_timeout, connect_kwargs={}):
         self.host = host
@@ -52,6 +63,28 @@ class Connection:
             else:
                 raise NotImplementedError(f"Argument {k} is not implemented")
 
+        # Socket of the shared SSH master connection. Unique per process, so
+        # that xdist workers don't step on each other. ssh expands %C to a hash
+        # of the host, port and user, which keeps the path short however long
+        # the host name is. Unix socket paths are limited to 108 bytes.
+        self.control_path = f"/tmp/mender-ssh-{os.getpid()}-%C"
+
+        # Result of bootenv_tools(). The tools don't change while the device is
+        # up, so they are only probed once. Cleared by reboot().
+        self._bootenv_tools_cache = None
+
+    def get_control_args(self):
+        """Returns the SSH options that make the connection reuse a shared
+        master connection, avoiding a new handshake for every command."""
+        return [
+            "-o",
+            "ControlMaster=auto",
+            "-o",
+            f"ControlPath={self.control_path}",
+            "-o",
+            "ControlPersist=60s",
+        ]
+
     def get_connect_args(self):
         if self.key_filename is not None:
             key_arg = ["-i", self.key_filename]
@@ -72,8 +105,9 @@ class Connection:
                 "UserKnownHostsFile=/dev/null",
                 "-o",
                 "StrictHostKeyChecking=no",
-                f"{self.user}@{self.host}",
             ]
+            + self.get_control_args()
+            + [f"{self.user}@{self.host}"]
         )
 
         return args
@@ -94,8 +128,7 @@ class Connection:
                 returncode = e.returncode
                 if returncode != 255:
                     if not hide:
-                        print(e.stdout.decode())
-                        print(e.stderr.decode())
+                        _print_output(e.stdout.decode(), e.stderr.decode())
                     raise
 
             if returncode == 255:
@@ -107,14 +140,92 @@ class Connection:
             stderr = proc.stderr.decode()
 
             if not hide:
-                print(stdout)
-                print(stderr)
+                _print_output(stdout, stderr)
 
             return Result(stdout, stderr, returncode)
 
+    # Printed after every command in run_many(), so that the combined output can
+    # be split back into one Result per command.
+    _RUN_MANY_SEP = re.compile(r"\n__MENDER_SEP__([0-9]+)__\n")
+
+    def run_many(self, commands, warn=False, hide=False, echo=True):
+        """Run several commands in a single SSH session and return a list with
+        one Result per command. The commands share the same remote shell, so
+        for example `cd` affects the commands that follow. Unless `warn` is
+        set, execution stops at the first failing command and
+        subprocess.CalledProcessError is raised, like run() does. It is also
+        raised, regardless of `warn`, if the remote shell exits before all
+        commands have run."""
+
+        script = ""
+        for command in commands:
+            script += (
+                f"{command}\n"
+                "rc=$?\n"
+                "printf '\\n__MENDER_SEP__%d__\\n' $rc\n"
+                "printf '\\n__MENDER_SEP__%d__\\n' $rc >&2\n"
+            )
+            if not warn:
+                script += '[ "$rc" -eq 0 ] || exit "$rc"\n'
+
+        result = self.run(script, warn=True, hide=True, echo=False)
+
+        stdout_parts = self._RUN_MANY_SEP.split(result.stdout)
+        stderr_parts = self._RUN_MANY_SEP.split(result.stderr)
+
+        results = []
+        for command, index in zip(commands, range(0, len(stdout_parts) - 1, 2)):
+            stdout = stdout_parts[index]
+            returncode = int(stdout_parts[index + 1])
+            if index + 1 < len(stderr_parts):
+                stderr = stderr_parts[index]
+            else:
+                stderr = ""
+
+            if echo:
+                print(command)
+            if not hide:
+                _print_output(stdout, stderr)
+
+            if returncode != 0 and not warn:
+                raise subprocess.CalledProcessError(
+                    returncode, command, output=stdout, stderr=stderr
+                )
+
+            results.append(Result(stdout, stderr, returncode))
+
+        # The remote shell stopped before all commands had run, for example
+        # because one of them called exit. Don't hand back a short list.
+        if len(results) < len(commands):
+            raise subprocess.CalledProcessError(
+                result.return_code,
+                commands[len(results)],
+                output=stdout_parts[-1],
+                stderr=stderr_parts[-1],
+            )
+
+        return results
+
     def local(self, command, warn=False):
         return subprocess.run(command, shell=True, check=not warn)
 
+    def close(self):
+        """Tear down the shared master connection, if there is one."""
+        subprocess.run(
+            [
+                "ssh",
+                "-o",
+                f"ControlPath={self.control_path}",
+                "-O",
+                "exit",
+                "-p",
+                str(self.port),
+                f"{self.user}@{self.host}",
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
 
 # Copied from filelock.py. The original code is public domain, so it's ok to
 # relicense. The main change from the original is the usage of LOCK_SH instead
@@ -123,7 +234,9 @@ class ReadFileLock(filelock.BaseFileLock):
     """Uses the :func:`fcntl.flock` to hard lock the lock file on unix systems."""
 
     def _acquire(self) -> None:
-        open_flags = os.O_RDWR | os.O_CREAT | os.O_TRUNC
+        # Unlike the original, don't truncate: a shared lock only needs read
+        # access, and must not modify the file under other holders.
+        open_flags = os.O_RDONLY | os.O_CREAT
         fd = os.open(self.lock_file, open_flags, self._context.mode)
         try:
             fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
@@ -145,7 +258,7 @@ class ReadFileLock(filelock.BaseFileLock):
 WriteFileLock = filelock.FileLock
 
 
-def get_worker_count():
+def _compute_worker_count():
     count = os.getenv("PYTEST_XDIST_WORKER_COUNT")
     if count is not None:
         return int(count)
@@ -153,7 +266,7 @@ def get_worker_count():
     return 1
 
 
-def get_worker_index():
+def _compute_worker_index():
     worker = os.getenv("PYTEST_XDIST_WORKER")
     if worker is not None:
         match = re.search("[0-9]+$", worker)
@@ -162,6 +275,20 @@ def get_worker_index():
     return 0
 
 
+# xdist sets up the environment before the worker imports this module, and it
+# doesn't change afterwards, so these only need to be computed once.
+_WORKER_COUNT = _compute_worker_count()
+_WORKER_INDEX = _compute_worker_index()
+
+
+def get_worker_count():
+    return _WORKER_COUNT
+
+
+def get_worker_index():
+    return _WORKER_INDEX
+
+
 def _start_qemu(qenv, conn, qemu_wrapper):
     """Start QEMU and return a subprocess.Popen object corresponding to a running
     qemu process.
@@ -182,8 +309,8 @@ def _start_qemu(qenv, conn, qemu_wrapper):
     env = dict(os.environ)
     env.update(qenv)
 
-    env["PORT_NUMBER"] = str(8822 + get_worker_index())
-    env["VNC_NUMBER"] = str(23 + get_worker_index())
+    env["PORT_NUMBER"] = str(8822 + _WORKER_INDEX)
+    env["VNC_NUMBER"] = str(23 + _WORKER_INDEX)
 
     proc = subprocess.Popen([qemu_wrapper], env=env, start_new_session=True)
 
@@ -205,6 +332,33 @@ def _start_qemu(qenv, conn, qemu_wrapper):
     return proc
 
 
+# ioctl request number from linux/fs.h.
+_FICLONE = 0x40049409
+
+
+def _fast_disposable_copy(src, dst):
+    """Copy src to dst as cheaply as the filesystem allows. Images are several
+    GB, so first try a reflink (btrfs, xfs), then an in-kernel copy, and only
+    then fall back to a regular copy."""
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+            return
+        except OSError:
+            pass
+
+        if hasattr(os, "copy_file_range"):
+            try:
+                while os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30) > 0:
+                    pass
+                return
+            except OSError:
+                # Not supported by the kernel or the filesystem.
+                pass
+
+    shutil.copyfile(src, dst)
+
+
 def start_qemu_block_storage(latest_sdimg, suffix, conn, qemu_wrapper):
     """Start qemu instance running block storage"""
     fh, img_path = tempfile.mkstemp(suffix=suffix, prefix="test-image")
@@ -212,7 +366,7 @@ def start_qemu_block_storage(latest_sdimg, suffix, conn, qemu_wrapper):
     os.close(fh)
 
     # Make a disposable image.
-    shutil.copy(latest_sdimg, img_path)
+    _fast_disposable_copy(latest_sdimg, img_path)
 
     # pass QEMU drive directly
     qenv = {}
@@ -245,7 +399,7 @@ def start_qemu_flash(latest_vexpress_nor, conn, qemu_wrapper):
     # passed to qemu). Because of this, we cannot directly apply qemu-img and
     # create a qcow2 image with backing file. Instead make a disposable copy of
     # flash image file.
-    shutil.copyfile(latest_vexpress_nor, img_path)
+    _fast_disposable_copy(latest_vexpress_nor, img_path)
 
     qenv = {}
     # pass QEMU drive directly
@@ -263,7 +417,15 @@ def start_qemu_flash(latest_vexpress_nor, conn, qemu_wrapper):
     return qemu, img_path
 
 
+_BOOT_ID_CMD = "cat /proc/sys/kernel/random/boot_id"
+
+
 def reboot(conn, wait=360):
+    # The device may come back up with a different image.
+    conn._bootenv_tools_cache = None
+
+    boot_id = conn.run(_BOOT_ID_CMD, hide=True).stdout.strip()
+
     try:
         conn.run("reboot", warn=True)
     except:
@@ -273,23 +435,37 @@ def reboot(conn, wait=360):
         # those will probably be caught below after the timeout).
         pass
 
-    # Make sure reboot has had time to take effect.
-    time.sleep(5)
-
-    run_after_connect("true", conn, wait=wait)
+    # Wait until we are talking to the new boot, not to the old one which is
+    # still shutting down.
+    timeout = time.time() + wait
+    while True:
+        remaining = max(timeout - time.time(), 1)
+        if run_after_connect(_BOOT_ID_CMD, conn, wait=remaining).strip() != boot_id:
+            break
+        if time.time() >= timeout:
+            raise TimeoutError("Device did not reboot within %d seconds" % wait)
+        time.sleep(1)
 
 
 def run_after_connect(cmd, conn, wait=360):
     # override the Connection parameters
     orig_timeout = conn.connect_timeout
-    conn.connect_timeout = 60
+    conn.connect_timeout = 5
     timeout = time.time() + wait
     latest_exception = None
+    delay = 1
 
     try:
         while time.time() < timeout:
             try:
                 print("will try to connect to host", conn.host)
+                # No point in spawning ssh if the port isn't even open yet.
+                try:
+                    socket.create_connection((conn.host, conn.port), timeout=2).close()
+                except OSError as e:
+                    raise ConnectionError(
+                        "Could not reach port %d: %s" % (conn.port, e)
+                    ) from e
                 result = conn.run(cmd, hide=True)
                 return result.stdout
             except ConnectionError as e:
@@ -297,7 +473,8 @@ def run_after_connect(cmd, conn, wait=360):
                 print(
                     "Got SSH exception while connecting to host %s: %s" % (conn.host, e)
                 )
-                time.sleep(30)
+                time.sleep(delay)
+                delay = min(8, delay * 2)
                 continue
             except Exception as e:
                 print(
@@ -318,120 +495,240 @@ def determine_active_passive_part(bitbake_variables, conn):
     """Given the output from mount, determine the currently active and passive
     partitions, returning them as a pair in that order."""
 
-    mount_output = conn.run("mount").stdout
+    return _active_passive_part_from_mount(bitbake_variables, conn.run("mount").stdout)
+
+
+def _active_passive_part_from_mount(bitbake_variables, mount_output):
     a = bitbake_variables["MENDER_ROOTFS_PART_A"]
     b = bitbake_variables["MENDER_ROOTFS_PART_B"]
 
-    if mount_output.find(a) >= 0:
-        return (a, b)
-    elif mount_output.find(b) >= 0:
-        return (b, a)
-    else:
+    # Look for both in a single pass. `re` caches the compiled pattern.
+    match = re.search("%s|%s" % (re.escape(a), re.escape(b)), mount_output)
+    if match is None:
         raise Exception(
             "Could not determine active partition. Mount output:\n {}"
             "\nwas looking for {}".format(mount_output, (a, b))
         )
 
+    # A takes precedence if both are mounted, also when B comes first.
+    if match.group(0) == a or a in mount_output[match.end() :]:
+        return (a, b)
+    else:
+        return (b, a)
+
 
-def get_ssh_common_args(conn):
-    args = "-o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null"
+def _get_scp_args(conn):
+    args = [
+        "scp",
+        "-O",
+        "-o",
+        "StrictHostKeyChecking=no",
+        "-o",
+        "UserKnownHostsFile=/dev/null",
+    ]
+    args += conn.get_control_args()
     if "key_filename" in conn.connect_kwargs.keys():
-        args += " -i %s" % conn.connect_kwargs["key_filename"]
+        args += ["-i", conn.connect_kwargs["key_filename"]]
+    args += ["-P", str(conn.port)]
     return args
 
 
 # Yocto build SSH is lacking SFTP, let's override and use regular SCP instead.
+# `file` may also be a list of files, which are then copied in one go.
 def put_no_sftp(file, conn, remote="."):
-    cmd = "scp -O %s" % get_ssh_common_args(conn)
-    conn.local(
-        "%s -P %s %s %s@%s:%s" % (cmd, conn.port, file, conn.user, conn.host, remote)
+    if isinstance(file, str):
+        file = [file]
+    subprocess.run(
+        _get_scp_args(conn) + file + [f"{conn.user}@{conn.host}:{remote}"],
+        check=True,
     )
 
 
 # Yocto build SSH is lacking SFTP, let's override and use regular SCP instead.
 def get_no_sftp(file, conn, local="."):
-    cmd = "scp -O %s" % get_ssh_common_args(conn)
-    conn.local(
-        "%s -P %s %s@%s:%s %s" % (cmd, conn.port, conn.user, conn.host, file, local)
+    subprocess.run(
+        _get_scp_args(conn) + [f"{conn.user}@{conn.host}:{file}", local], check=True
     )
 
 
 def manual_uboot_commit(conn):
     _, bootenv_set = bootenv_tools(conn)
-    conn.run(f"{bootenv_set} upgrade_available 0")
-    conn.run(f"{bootenv_set} bootcount 0")
+    conn.run_many([f"{bootenv_set} upgrade_available 0", f"{bootenv_set} bootcount 0"])
 
 
-def latest_build_artifact(request, builddir, extension):
+# Results of latest_build_artifacts(), keyed on the directory pattern, the
+# extensions and the modification times of the directories it searches. New
+# artifacts are renamed into place by bitbake, which updates the directory, so a
+# changed build is noticed without scanning all the files again.
+_LATEST_BUILD_ARTIFACT_CACHE = {}
+
+
+def latest_build_artifacts(request, builddir, extensions):
+    """Returns a dict mapping each of `extensions` to the most recently modified
+    build artifact ending in it, or to "" if there is none. The extensions may
+    contain glob patterns. The deploy directories are only scanned once, no
+    matter how many extensions are asked for."""
 
     # Force the builddir to be an absolute path
     builddir = os.path.abspath(builddir)
 
     if request.config.getoption("--test-conversion"):
-        output = subprocess.check_output(
-            [
-                "sh",
-                "-c",
-                "ls -t %s/*%s | grep -v data*%s| head -n 1"
-                % (builddir, extension, extension),
-            ]
-        )
+        dir_pattern = builddir
     else:
-        output = subprocess.check_output(
-            [
-                "sh",
-                "-c",
-                "ls -t %s/tmp*/deploy/images/*/*%s | grep -v data*%s| head -n 1"
-                % (builddir, extension, extension),
-            ]
-        )
-    output = output.decode().rstrip("\r\n")
-    print("Found latest image of type '%s' to be: %s" % (extension, output))
-    return output
+        dir_pattern = os.path.join(builddir, "tmp*", "deploy", "images", "*")
 
+    dirs = [path for path in glob.glob(dir_pattern) if os.path.isdir(path)]
+    key = (
+        dir_pattern,
+        tuple(extensions),
+        tuple((path, os.stat(path).st_mtime_ns) for path in dirs),
+    )
+    output = _LATEST_BUILD_ARTIFACT_CACHE.get(key)
+    if output is None:
+        latest = {extension: ("", -1) for extension in extensions}
+        for path in dirs:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    # Hidden files are not matched by a glob either.
+                    if entry.name.startswith("."):
+                        continue
+                    for extension in extensions:
+                        # Skip data partition images.
+                        if not fnmatch.fnmatch(entry.name, "*%s" % extension):
+                            continue
+                        if fnmatch.fnmatch(entry.name, "data*%s" % extension):
+                            continue
+                        # Don't follow symlinks, like `ls -t` didn't, so a
+                        # dangling link doesn't break the lookup.
+                        mtime = entry.stat(follow_symlinks=False).st_mtime
+                        if mtime > latest[extension][1]:
+                            latest[extension] = (entry.path, mtime)
+        output = {extension: latest[extension][0] for extension in extensions}
+        _LATEST_BUILD_ARTIFACT_CACHE[key] = output
+
+    for extension in extensions:
+        print(
+            "Found latest image of type '%s' to be: %s" % (extension, output[extension])
+        )
+    return dict(output)
 
-def get_bitbake_variables(request, target, prepared_test_build, export_only=False):
-    lines = []
 
-    if request.config.getoption("--test-conversion"):
-        config_file_path = os.path.abspath(request.config.getoption("--test-variables"))
-        with open(config_file_path, "r") as config:
-            lines = config.readlines()
-    else:
-        current_dir = os.open(".", os.O_RDONLY)
-        os.chdir(os.environ["BUILDDIR"])
-        if prepared_test_build is not None:
-            env_setup = "cd %s && . oe-init-build-env %s &&" % (
-                prepared_test_build["bitbake_corebase"],
-                prepared_test_build["build_dir"],
-            )
-        else:
-            env_setup = "flock bitbake.test.lock"
-        ps = subprocess.Popen(
-            "%s bitbake -e %s" % (env_setup, target),
-            stdout=subprocess.PIPE,
-            shell=True,
-            executable="/bin/bash",
+def latest_build_artifact(request, builddir, extension):
+    return latest_build_artifacts(request, builddir, [extension])[extension]
+
+
+def _iter_line_blocks(stream, block_size=65536):
+    """Yields lists of the complete lines, as bytes, in each block read from a
+    binary stream. The stream is read in large blocks rather than line by line,
+    which is a lot cheaper for the huge output of bitbake."""
+    pending = b""
+    while True:
+        # read1() returns whatever is available, so lines are still yielded as
+        # soon as they arrive.
+        block = stream.read1(block_size)
+        if not block:
+            break
+        lines = (pending + block).split(b"\n")
+        pending = lines.pop()
+        if lines:
+            yield [line + b"\n" for line in lines]
+    if pending:
+        yield [pending]
+
+
+def _iter_lines(stream, block_size=65536):
+    """Yields the lines of a binary stream as bytes, see _iter_line_blocks()."""
+    for lines in _iter_line_blocks(stream, block_size):
+        yield from lines
+
+
+_BITBAKE_EXPORT_RE = re.compile('^export ([A-Za-z][^=]*)="(.*)"$')
+_BITBAKE_VAR_RE = re.compile('^(?:export )?([A-Za-z][^=]*)="(.*)"$')
+
+
+# `bitbake -e` takes a long time, so its parsed results are kept here, keyed on
+# the build configuration. The oldest entry is dropped once the cache is full.
+_BITBAKE_VARIABLES_CACHE = {}
+_BITBAKE_VARIABLES_CACHE_SIZE = 16
+
+
+def _bitbake_conf_digest(build_dir):
+    # Use the contents of the configuration rather than modification times,
+    # since reset_build_conf() touches the files before every test. All of
+    # conf/*.conf is included (local.conf, bblayers.conf, auto.conf, site.conf,
+    # ...), but not the *.orig copies. Files that these `require` from outside
+    # conf/ are not, so changing those during a session is not noticed.
+    digest = hashlib.sha256()
+    for conf in sorted(glob.glob(os.path.join(build_dir, "conf", "*.conf"))):
+        try:
+            with open(conf, "rb") as fd:
+                digest.update(os.path.basename(conf).encode() + b"\0")
+                digest.update(fd.read())
+        except FileNotFoundError:
+            pass
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def bitbake_inputs_digest(build_dir, layers):
+    """Returns a digest of what a build in `build_dir` depends on: its
+    configuration, and the checked out revision and local changes of each of
+    `layers`. Returns None if a layer is not a git checkout, since then there is
+    no cheap way to tell whether it changed. Untracked files are only noticed
+    by name, not by content."""
+    digest = hashlib.sha256(_bitbake_conf_digest(build_dir).encode())
+    for layer in layers:
+        try:
+            for git_cmd in [
+                ["rev-parse", "HEAD"],
+                ["status", "--porcelain"],
+                ["diff", "HEAD"],
+            ]:
+                digest.update(
+                    subprocess.check_output(
+                        ["git", "-C", layer] + git_cmd, stderr=subprocess.DEVNULL
+                    )
+                )
+        except (subprocess.CalledProcessError, OSError):
+            return None
+        digest.update(layer.encode() + b"\0")
+    return digest.hexdigest()
+
+
+def _run_bitbake_e(target, prepared_test_build):
+    """Yields the output of `bitbake -e` line by line, as it is produced. The
+    output can be hundreds of MB, so it is never kept around in full."""
+    current_dir = os.open(".", os.O_RDONLY)
+    os.chdir(os.environ["BUILDDIR"])
+    if prepared_test_build is not None:
+        env_setup = "cd %s && . oe-init-build-env %s &&" % (
+            prepared_test_build["bitbake_corebase"],
+            prepared_test_build["build_dir"],
         )
-        os.fchdir(current_dir)
+    else:
+        env_setup = "flock bitbake.test.lock"
+    ps = subprocess.Popen(
+        "%s bitbake -e %s" % (env_setup, target),
+        stdout=subprocess.PIPE,
+        shell=True,
+        executable="/bin/bash",
+    )
+    os.fchdir(current_dir)
 
-        while True:
-            line = ps.stdout.readline()
-            if not line:
-                break
-            lines.append(line.decode())
+    for line in _iter_lines(ps.stdout):
+        yield line.decode()
 
-        ps.wait()
+    ps.wait()
 
+
+def _parse_bitbake_variables(lines, export_only):
     if export_only:
-        export_only_expr = ""
+        matcher = _BITBAKE_EXPORT_RE
     else:
-        export_only_expr = "?"
-    matcher = re.compile('^(?:export )%s([A-Za-z][^=]*)="(.*)"$' % export_only_expr)
+        matcher = _BITBAKE_VAR_RE
     ret = {}
     for line in lines:
-        line = line.strip()
-        match = matcher.match(line)
+        match = matcher.match(line.strip())
         if match is not None:
             ret[match.group(1)] = match.group(2)
 
@@ -446,6 +743,112 @@ def get_bitbake_variables(request, target, prepared_test_build, export_only=Fals
     return ret
 
 
+def _read_bitbake_variables_cache_file(cache_file, key):
+    try:
+        with open(cache_file, "r") as fd:
+            cached = json.load(fd)
+    except (FileNotFoundError, ValueError):
+        return None
+    if cached.get("key") != key:
+        return None
+    return cached["variables"]
+
+
+# Set by the test session controller to a directory that only lives as long as
+# the test run. See create_bitbake_variables_cache_dir().
+_BITBAKE_VARIABLES_CACHE_DIR_ENV = "MENDER_BITBAKE_VARIABLES_CACHE_DIR"
+
+
+def create_bitbake_variables_cache_dir():
+    """Creates the directory where xdist workers share `bitbake -e` results for
+    the current test run. Call it before the workers are started, so that they
+    inherit the location."""
+    os.environ[_BITBAKE_VARIABLES_CACHE_DIR_ENV] = tempfile.mkdtemp(
+        prefix="mender-bitbake-e-"
+    )
+
+
+def remove_bitbake_variables_cache_dir():
+    cache_dir = os.environ.pop(_BITBAKE_VARIABLES_CACHE_DIR_ENV, None)
+    if cache_dir is not None:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def _load_bitbake_variables(
+    target, prepared_test_build, build_dir, digest, export_only
+):
+    """Returns the variables from the on-disk cache of the current test run,
+    which is shared between xdist workers. If the cache is missing or stale,
+    run `bitbake -e` and store the result, so that only one worker pays for it.
+
+    Only the main build directory is shared between workers. The test build
+    directories belong to a single worker, whose in-process cache is enough."""
+
+    cache_dir = os.getenv(_BITBAKE_VARIABLES_CACHE_DIR_ENV)
+    if (
+        cache_dir is None
+        or prepared_test_build is not None
+        or os.getenv("PYTEST_XDIST_WORKER") is None
+    ):
+        return _parse_bitbake_variables(
+            _run_bitbake_e(target, prepared_test_build), export_only
+        )
+    key = [build_dir, digest]
+
+    name = re.sub("[^A-Za-z0-9_.-]", "_", target)
+    if export_only:
+        name += ".export"
+    cache_file = os.path.join(cache_dir, "%s.json" % name)
+    lock_file = os.path.join(cache_dir, "lock")
+
+    with ReadFileLock(lock_file):
+        ret = _read_bitbake_variables_cache_file(cache_file, key)
+    if ret is not None:
+        return ret
+
+    with WriteFileLock(lock_file):
+        # Another worker may have filled the cache while we were waiting.
+        ret = _read_bitbake_variables_cache_file(cache_file, key)
+        if ret is not None:
+            return ret
+
+        ret = _parse_bitbake_variables(
+            _run_bitbake_e(target, prepared_test_build), export_only
+        )
+
+        tmp_file = "%s.%d" % (cache_file, os.getpid())
+        with open(tmp_file, "w") as fd:
+            json.dump({"key": key, "variables": ret}, fd)
+        os.rename(tmp_file, cache_file)
+
+    return ret
+
+
+def get_bitbake_variables(request, target, prepared_test_build, export_only=False):
+    if request.config.getoption("--test-conversion"):
+        config_file_path = os.path.abspath(request.config.getoption("--test-variables"))
+        with open(config_file_path, "r") as config:
+            return _parse_bitbake_variables(config, export_only)
+
+    if prepared_test_build is not None:
+        build_dir = os.path.abspath(prepared_test_build["build_dir"])
+    else:
+        build_dir = os.path.abspath(os.environ["BUILDDIR"])
+
+    digest = _bitbake_conf_digest(build_dir)
+    cache_key = (target, build_dir, digest, export_only)
+    ret = _BITBAKE_VARIABLES_CACHE.get(cache_key)
+    if ret is None:
+        ret = _load_bitbake_variables(
+            target, prepared_test_build, build_dir, digest, export_only
+        )
+        if len(_BITBAKE_VARIABLES_CACHE) >= _BITBAKE_VARIABLES_CACHE_SIZE:
+            del _BITBAKE_VARIABLES_CACHE[next(iter(_BITBAKE_VARIABLES_CACHE))]
+        _BITBAKE_VARIABLES_CACHE[cache_key] = ret
+
+    return dict(ret)
+
+
 def signing_key(key_type):
     # RSA pregenerated using these.
     #   openssl genrsa -out files/test-private-RSA.pem 2048
@@ -514,31 +917,34 @@ def build_image(
         _run_bitbake(bitbake_image, init_env_cmd, capture)
 
 
+_UNRECOGNIZED_MENDER_VAR = b"is not a recognized MENDER_ variable"
+
+
 def _run_bitbake(target, env_setup_cmd, capture=False):
     cmd = "%s && bitbake %s" % (env_setup_cmd, target)
     ps = run_verbose(cmd, capture=subprocess.PIPE)
-    output = ""
+    output_parts = []
     try:
-        # Cannot use for loop here due to buffering and iterators.
-        while True:
-            line = ps.stdout.readline().decode()
-            if not line:
-                break
-
-            if line.find("is not a recognized MENDER_ variable") >= 0:
-                pytest.fail(
-                    "Found variable which is not in mender-vars.json: %s" % line.strip()
-                )
+        for lines in _iter_line_blocks(ps.stdout):
+            for line in lines:
+                if _UNRECOGNIZED_MENDER_VAR in line:
+                    pytest.fail(
+                        "Found variable which is not in mender-vars.json: %s"
+                        % line.decode().strip()
+                    )
+
+            # Handle the whole block at once, rather than line by line.
+            text = b"".join(lines).decode()
 
             if capture:
-                output += line
+                output_parts.append(text)
             else:
-                sys.stdout.write(line)
+                sys.stdout.write(text)
     finally:
         # Empty any remaining lines.
         try:
             if capture:
-                output += ps.stdout.readlines().decode()
+                output_parts.extend(line.decode() for line in ps.stdout.readlines())
             else:
                 ps.stdout.readlines()
         except:
@@ -547,10 +953,10 @@ def _run_bitbake(target, env_setup_cmd, capture=False):
         if ps.returncode != 0:
             e = subprocess.CalledProcessError(ps.returncode, cmd)
             if capture:
-                e.output = output
+                e.output = "".join(output_parts)
             raise e
 
-    return output
+    return "".join(output_parts)
 
 
 # Make sure we are constructing the paths the same way always
@@ -600,6 +1006,7 @@ def reset_build_conf(build_dir, full_cleanup=False):
 
 class bitbake_env_from:
     old_env = {}
+    new_keys = []
     old_path = None
     recipe = None
     prepared_test_build = None
@@ -620,15 +1027,12 @@ class bitbake_env_from:
         else:
             vars = self.recipe
 
-        self.old_env = {}
-        # Save all values that have keys in the bitbake_env_dict
-        for key in vars:
-            if key in os.environ:
-                self.old_env[key] = os.environ[key]
-            else:
-                self.old_env[key] = None
+        # Take one snapshot of the environment, and remember which keys we
+        # touch, so that teardown only needs to restore those.
+        self.old_env = dict(os.environ)
+        self.new_keys = list(vars) + ["PATH"]
 
-        self.old_path = os.environ["PATH"]
+        self.old_path = self.old_env["PATH"]
 
         os.environ.update(vars)
         # Exception for PATH, keep old path at end.
@@ -640,12 +1044,22 @@ class bitbake_env_from:
         self.teardown()
 
     def teardown(self):
-        # Restore all keys we saved.
-        for key in self.old_env:
-            if self.old_env[key] is None:
-                del os.environ[key]
-            else:
+        # Restore all keys we changed.
+        for key in self.new_keys:
+            if key in self.old_env:
                 os.environ[key] = self.old_env[key]
+            else:
+                os.environ.pop(key, None)
+
+
+@functools.lru_cache(maxsize=None)
+def _parse_version(version):
+    """Returns the parsed version, or None if it is not a valid version. Cached,
+    since the same few versions are compared for every test."""
+    try:
+        return packaging.version.Version(version)
+    except packaging.version.InvalidVersion:
+        return None
 
 
 def version_is_minimum(bitbake_variables, component, min_version, recurse=True):
@@ -671,14 +1085,13 @@ def version_is_minimum(bitbake_variables, component, min_version, recurse=True):
         # Assume it is the final tag.
         version = version[: version.find("-build")]
 
-    try:
-        version_parsed = packaging.version.Version(version)
-    except packaging.version.InvalidVersion:
+    version_parsed = _parse_version(version)
+    if version_parsed is None:
         # Indicates that 'version' is likely a string (branch name).
         # Always consider them higher than the minimum version.
         return True
 
-    return version_parsed >= packaging.version.Version(min_version)
+    return version_parsed >= _parse_version(min_version)
 
 
 def is_cpp_client(bitbake_variables):
@@ -729,37 +1142,91 @@ def qemu_system_time(connection):
 def bootenv_tools(connection):
     """Returns a tuple containing the print and set tools of the current bootloader."""
 
-    result = connection.run("test -x /usr/bin/grub-mender-grubenv-print", warn=True)
+    _, tools = _run_with_bootenv_tools(connection, [])
+    return tools
+
+
+_GRUBENV_PROBE = "test -x /usr/bin/grub-mender-grubenv-print"
+
+
+def _bootenv_tools_from_probe(result):
     if result.return_code == 0:
         return ("grub-mender-grubenv-print", "grub-mender-grubenv-set")
     else:
         return ("fw_printenv", "fw_setenv")
 
 
+def _run_with_bootenv_tools(connection, commands):
+    """Runs `commands` and returns a list of their results, together with the
+    bootenv tools. If the tools are not cached on the connection yet, they are
+    probed in the same SSH roundtrip."""
+    if connection._bootenv_tools_cache is None:
+        *results, probe = connection.run_many(commands + [_GRUBENV_PROBE], warn=True)
+        connection._bootenv_tools_cache = _bootenv_tools_from_probe(probe)
+    elif commands:
+        results = connection.run_many(commands, warn=True)
+    else:
+        results = []
+    return results, connection._bootenv_tools_cache
+
+
+def probe_device_state(bitbake_variables, connection):
+    """Does the work of both determine_active_passive_part() and bootenv_tools()
+    in a single SSH roundtrip. Returns a tuple with their results, in that
+    order."""
+
+    (mount,), tools = _run_with_bootenv_tools(connection, ["mount"])
+    return (_active_passive_part_from_mount(bitbake_variables, mount.stdout), tools)
+
+
+_PARTITION_NUMBER_RE = re.compile("([0-9]+)$")
+
+
 def extract_partition(img, number, dst):
-    output = subprocess.Popen(
-        ["fdisk", "-l", "-o", "device,start,end", img], stdout=subprocess.PIPE
-    )
+    table = json.loads(subprocess.check_output(["sfdisk", "--json", img]))[
+        "partitiontable"
+    ]
+    sector_size = table.get("sectorsize", 512)
     start = None
-    end = None
-    for line in output.stdout:
-        if re.search("img%d" % number, line.decode()) is None:
-            continue
-
-        match = re.match(r"\s*\S+\s+(\S+)\s+(\S+)", line.decode())
-        assert match is not None
-        start = int(match.group(1))
-        end = int(match.group(2)) + 1
-    output.wait()
+    size = None
+    for part in table["partitions"]:
+        match = _PARTITION_NUMBER_RE.search(part["node"])
+        if match is not None and int(match.group(1)) == number:
+            start = part["start"]
+            size = part["size"]
 
     assert start is not None
-    assert end is not None
+    assert size is not None
+
+    output = f"{dst}/img{number}.fs"
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(img, "rb") as fsrc, open(output, "wb") as fdst:
+                offset = start * sector_size
+                remaining = size * sector_size
+                while remaining > 0:
+                    copied = os.copy_file_range(
+                        fsrc.fileno(),
+                        fdst.fileno(),
+                        min(remaining, 1 << 30),
+                        offset_src=offset,
+                    )
+                    if copied == 0:
+                        break
+                    offset += copied
+                    remaining -= copied
+            return
+        except OSError:
+            # Not supported by the kernel or the filesystem, use dd instead.
+            pass
+
     subprocess.check_call(
         [
             "dd",
             "if=" + img,
-            f"of={dst}/img{number}.fs",
+            "of=" + output,
+            "bs=%d" % sector_size,
             "skip=%d" % start,
-            "count=%d" % (end - start),
+            "count=%d" % size,
         ]
     )
@@ -16,22 +16,24 @@
 import os
 import signal
 import shutil
-import time
 import errno
+import glob
 import subprocess
 import tempfile
-import random
-import string
+import itertools
+import types
 from pathlib import Path
 
 import pytest
 from ..common import (
     build_image,
+    bitbake_inputs_digest,
     Connection,
     ReadFileLock,
     WriteFileLock,
     manual_uboot_commit,
     latest_build_artifact,
+    latest_build_artifacts,
     run_verbose,
     reset_build_conf,
     get_local_conf_path,
@@ -51,31 +53,31 @@ from ..common import (
 
 @pytest.fixture(scope="function", autouse=True)
 def exclusivity(request):
+    # Without parallel workers there is nothing to be exclusive against, so
+    # don't bother with the lock file.
+    if get_worker_count() == 1:
+        return None
+
+    # Every worker has its own lock file, which only that worker takes shared
+    # locks on, so normal tests don't contend with other workers. An exclusive
+    # test write-locks the files of all workers, always in the same order.
     if request.node.get_closest_marker("exclusive"):
-        lock = WriteFileLock("exclusive.test.lock")
+        locks = [
+            WriteFileLock("exclusive.test.lock.%d" % index)
+            for index in range(get_worker_count())
+        ]
     else:
-        lock = ReadFileLock("exclusive.test.lock")
-
-    lock.acquire()
-
-    request.addfinalizer(lock.release)
+        locks = [ReadFileLock("exclusive.test.lock.%d" % get_worker_index())]
 
-    return lock
+    for lock in locks:
+        lock.acquire()
+        request.addfinalizer(lock.release)
 
-
-def config_host(host):
-    host_info = host.split(":")
-
-    if len(host_info) == 2:
-        return host_info[0], int(host_info[1])
-    elif len(host_info) == 1:
-        return host_info[0], 8822 + get_worker_index()
-    else:
-        return "localhost", 8822 + get_worker_index()
+    return locks
 
 
 def connection_factory(request, user, host, ssh_priv_key):
-    host, port = config_host(host)
+    host, port = host
     connect_kwargs = {}
     if ssh_priv_key != "":
         connect_kwargs["key_filename"] = ssh_priv_key
@@ -92,15 +94,22 @@ def connection_factory(request, user, host, ssh_priv_key):
 
 @pytest.fixture(scope="session")
 def session_connection(request, user, host, ssh_priv_key):
-    return connection_factory(request, user, host, ssh_priv_key)
+    conn = connection_factory(request, user, host, ssh_priv_key)
+    request.addfinalizer(conn.close)
+    return conn
 
 
 @pytest.fixture(scope="function")
-def connection(request, session_connection):
+def connection(request, session_connection, cli_opts):
+    # Looking for coverage files costs a round trip after every test, so it is
+    # only done when asked for.
+    if not cli_opts.collect_coverage:
+        return session_connection
+
     def collect_coverage():
-        # Collect the coverage files from /data/mender/ if present
+        # Collect the coverage files from /data/mender/ if present. Copying
+        # fails if there are none, which saves a separate check for them.
         try:
-            session_connection.run("ls /data/mender/cover*")
             Path("coverage").mkdir(exist_ok=True)
             get_no_sftp("/data/mender/cover*", session_connection, local="coverage")
             session_connection.run("rm -f /data/mender/cover*")
@@ -112,21 +121,17 @@ def connection(request, session_connection):
     return session_connection
 
 
-def pid_exists(pid):
-    try:
-        os.kill(pid, 0)
-    except OSError:
-        return False
-    else:
-        return True
-
-
 def setup_qemu(request, qemu_wrapper, build_dir, conn):
-    latest_sdimg = latest_build_artifact(request, build_dir, ".sdimg")
-    latest_uefiimg = latest_build_artifact(request, build_dir, ".uefiimg")
-    latest_biosimg = latest_build_artifact(request, build_dir, ".biosimg")
-    latest_gptimg = latest_build_artifact(request, build_dir, ".gptimg")
-    latest_vexpress_nor = latest_build_artifact(request, build_dir, ".vexpress-nor")
+    latest = latest_build_artifacts(
+        request,
+        build_dir,
+        [".sdimg", ".uefiimg", ".biosimg", ".gptimg", ".vexpress-nor"],
+    )
+    latest_sdimg = latest[".sdimg"]
+    latest_uefiimg = latest[".uefiimg"]
+    latest_biosimg = latest[".biosimg"]
+    latest_gptimg = latest[".gptimg"]
+    latest_vexpress_nor = latest[".vexpress-nor"]
 
     if latest_sdimg:
         qemu, img_path = start_qemu_block_storage(
@@ -158,42 +163,62 @@ def setup_qemu(request, qemu_wrapper, build_dir, conn):
     def qemu_finalizer():
         def qemu_finalizer_impl(conn):
 
-            # collect logs before shutting down
+            shutdown_timeout_s = 30
+
+            # collect logs before shutting down. The journal is streamed
+            # straight into the local file, in the background while the
+            # firmware variables are cleared below.
+            journal = None
             try:
                 # TODO: this should be a configurable list of logs to collect
                 log_path = "/tmp/journalctl.log"
-                conn.run(f"journalctl --no-pager > {log_path}")
-                get_no_sftp(log_path, conn, local=log_path)
-                print("QEMU machine logs collected successfully before shutdown.")
+                with open(log_path, "wb") as log_file:
+                    journal = subprocess.Popen(
+                        conn.get_connect_args() + ["journalctl --no-pager"],
+                        stdout=log_file,
+                    )
             except Exception as e:
                 print(f"Failed to collect QEMU logs before shutdown: {e}")
 
-            shutdown_timeout_s = 30
             # Try clearing firmware variables
             try:
                 manual_uboot_commit(conn)
             except:
                 pass
 
+            # The logs have to be complete before powering off.
+            if journal is not None:
+                try:
+                    if journal.wait(timeout=shutdown_timeout_s) == 0:
+                        print(
+                            "QEMU machine logs collected successfully before shutdown."
+                        )
+                    else:
+                        print(
+                            "Failed to collect QEMU logs before shutdown: "
+                            f"exit code {journal.returncode}"
+                        )
+                except subprocess.TimeoutExpired:
+                    journal.kill()
+                    journal.wait()
+                    print("Failed to collect QEMU logs before shutdown: timed out")
+
             # Try clean poweroff
             try:
                 conn.run("poweroff")
-                halt_time = time.time()
                 # Wait up to 30 seconds for shutdown.
-                while (
-                    halt_time + shutdown_timeout_s > time.time() and qemu.poll() is None
-                ):
-                    time.sleep(1)
+                qemu.wait(timeout=shutdown_timeout_s)
             except:
                 pass
 
             # Terminate qemu
             try:
                 os.killpg(os.getpgid(qemu.pid), signal.SIGTERM)
-                while pid_exists(qemu.pid) and shutdown_timeout_s > 0:
-                    time.sleep(1)
+                # Give it a moment to terminate before killing it for good.
+                try:
+                    qemu.wait(timeout=1)
+                except subprocess.TimeoutExpired:
                     os.killpg(os.getpgid(qemu.pid), signal.SIGKILL)
-                    shutdown_timeout_s = shutdown_timeout_s - 1
             except OSError as oserr:
                 # qemu might have exited before we reached this place
                 if oserr.errno == errno.ESRCH:
@@ -220,7 +245,13 @@ def setup_hardware_test_board(request, conn):
 
 @pytest.fixture(scope="session")
 def setup_board(
-    request, qemu_wrapper, build_image_fn, session_connection, board_type, conversion
+    request,
+    qemu_wrapper,
+    build_image_fn,
+    session_connection,
+    board_type,
+    conversion,
+    cli_opts,
 ):
 
     print("board type: ", board_type)
@@ -228,9 +259,7 @@ def setup_board(
     if "qemu" in board_type:
         image_dir = build_image_fn()
         return setup_qemu(request, qemu_wrapper, image_dir, session_connection)
-    elif "raspberrypi4" in board_type and request.config.getoption(
-        "--hardware-testing"
-    ):
+    elif "raspberrypi4" in board_type and cli_opts.hardware_testing:
         worker_count = get_worker_count()
         assert worker_count == 1, "Only QEMU is supported when using multiple workers"
         return setup_hardware_test_board(request, session_connection)
@@ -320,31 +349,18 @@ def latest_part_image(request, conversion, mender_image):
     else:
         pattern = "core-image*"
 
-    # Find latest built rootfs.
-    latest_sdimg = latest_build_artifact(
-        request, os.environ["BUILDDIR"], "%s.sdimg" % pattern
-    )
-    latest_uefiimg = latest_build_artifact(
-        request, os.environ["BUILDDIR"], "%s.uefiimg" % pattern
-    )
-    latest_biosimg = latest_build_artifact(
-        request, os.environ["BUILDDIR"], "%s.biosimg" % pattern
-    )
-    latest_gptimg = latest_build_artifact(
-        request, os.environ["BUILDDIR"], "%s.gptimg" % pattern
-    )
-    if latest_sdimg:
-        return latest_sdimg
-    elif latest_uefiimg:
-        return latest_uefiimg
-    elif latest_biosimg:
-        return latest_biosimg
-    elif latest_gptimg:
-        return latest_gptimg
-    else:
-        # Tempting to throw an exception here, but this runs even for platforms
-        # that skip the test, so we should return None instead.
-        return None
+    # Find latest built rootfs, in order of preference.
+    extensions = [
+        "%s.%s" % (pattern, ext) for ext in ["sdimg", "uefiimg", "biosimg", "gptimg"]
+    ]
+    latest = latest_build_artifacts(request, os.environ["BUILDDIR"], extensions)
+    for extension in extensions:
+        if latest[extension]:
+            return latest[extension]
+
+    # Tempting to throw an exception here, but this runs even for platforms
+    # that skip the test, so we should return None instead.
+    return None
 
 
 @pytest.fixture(scope="function")
@@ -384,32 +400,70 @@ def bitbake_variables(request, conversion, sdimg_location):
     )
 
 
+def _sysroot_prepared(stamp, inputs_file, inputs):
+    if inputs is None:
+        return False
+
+    # Only the task stamp itself counts, not the signature data next to it.
+    stamps = [
+        path
+        for path in glob.glob("%s.do_prepare_recipe_sysroot.*" % stamp)
+        if ".sigdata." not in path and not path.endswith(".siginfo")
+    ]
+    if not stamps:
+        return False
+
+    try:
+        with open(inputs_file) as fd:
+            return fd.read() == inputs
+    except FileNotFoundError:
+        return False
+
+
 @pytest.fixture(scope="session")
 def bitbake_path(request, conversion, prepared_test_build_base):
-    """Fixture that enables the PATH we need for our testing tools."""
+    """Fixture that enables the PATH we need for our testing tools. The tests
+    run the tools through plain subprocess calls, which inherit os.environ, so
+    the PATH is set for the whole session and restored afterwards."""
 
     old_path = os.environ["PATH"]
+    if conversion:
+        return old_path
 
-    if not conversion:
+    bb_testing_variables = get_bitbake_variables(
+        request,
+        "mender-test-dependencies",
+        prepared_test_build=prepared_test_build_base,
+    )
+    # Even with nothing to do, bitbake takes a long time to start, so skip it if
+    # the sysroot was prepared in this build directory from the same
+    # configuration and layers before, which happens when the directory is kept
+    # between runs. Changes that don't show up in the configuration or in the
+    # layers' git state, such as host tool updates, are not noticed.
+    sysroot = bb_testing_variables["RECIPE_SYSROOT_NATIVE"]
+    inputs_file = os.path.join(sysroot, ".mender-test-inputs")
+    inputs = bitbake_inputs_digest(
+        prepared_test_build_base["build_dir"], bb_testing_variables["BBLAYERS"].split()
+    )
+    if not _sysroot_prepared(bb_testing_variables["STAMP"], inputs_file, inputs):
         build_image(
             prepared_test_build_base["build_dir"],
             prepared_test_build_base["bitbake_corebase"],
             "mender-test-dependencies",
             target="-c prepare_recipe_sysroot mender-test-dependencies",
         )
-        bb_testing_variables = get_bitbake_variables(
-            request,
-            "mender-test-dependencies",
-            prepared_test_build=prepared_test_build_base,
-        )
-        os.environ["PATH"] = bb_testing_variables["PATH"] + ":" + os.environ["PATH"]
+        if inputs is not None:
+            with open(inputs_file, "w") as fd:
+                fd.write(inputs)
+    path = bb_testing_variables["PATH"] + ":" + old_path
+    os.environ["PATH"] = path
 
     def path_restore():
         os.environ["PATH"] = old_path
 
     request.addfinalizer(path_restore)
 
-    return os.environ["PATH"]
+    return path
 
 
 @pytest.fixture(scope="session")
@@ -465,7 +519,7 @@ def prepared_test_build_base_impl(
 
     def cleanup_test_build():
         if not no_tmp_build_dir and not keep_tmp_build_dir:
-            run_verbose("rm -rf %s" % build_dir)
+            shutil.rmtree(build_dir, ignore_errors=True)
         else:
             reset_build_conf(build_dir, full_cleanup=True)
 
@@ -479,16 +533,20 @@ def prepared_test_build_base_impl(
     run_verbose(env_setup)
 
     if not no_tmp_build_dir:
-        run_verbose("cp %s/conf/* %s/conf" % (os.environ["BUILDDIR"], build_dir))
+        # Same files as `cp conf/*` would copy: no hidden files, no directories.
+        for path in Path(os.environ["BUILDDIR"], "conf").iterdir():
+            if path.is_file() and not path.name.startswith("."):
+                shutil.copy(path, os.path.join(build_dir, "conf"))
+        sstate_dir = bitbake_variables["SSTATE_DIR"]
+        dl_dir = bitbake_variables["DL_DIR"]
         with open(local_conf, "a") as fd:
             fd.write(
-                'SSTATE_MIRRORS = " file://.* file://%s/PATH"\n'
-                % bitbake_variables["SSTATE_DIR"]
+                f'SSTATE_MIRRORS = " file://.* file://{sstate_dir}/PATH"\n'
+                f'DL_DIR = "{dl_dir}"\n'
             )
-            fd.write('DL_DIR = "%s"\n' % bitbake_variables["DL_DIR"])
 
-    run_verbose("cp %s %s" % (local_conf, local_conf_orig))
-    run_verbose("cp %s %s" % (bblayers_conf, bblayers_conf_orig))
+    shutil.copy(local_conf, local_conf_orig)
+    shutil.copy(bblayers_conf, bblayers_conf_orig)
 
     return {"build_dir": build_dir, "bitbake_corebase": bitbake_variables["COREBASE"]}
 
@@ -519,6 +577,11 @@ def prepared_test_build(prepared_test_build_base):
     return prepared_test_build_base
 
 
+# Numbers the class scoped build directories. Together with the worker index
+# this keeps the directory names unique without picking random ones.
+_CLASS_BUILD_COUNTER = itertools.count()
+
+
 @pytest.fixture(scope="class")
 def class_scoped_prepared_test_build_base(
     request, conversion, bitbake_variables, no_tmp_build_dir, keep_tmp_build_dir
@@ -529,7 +592,7 @@ def class_scoped_prepared_test_build_base(
         bitbake_variables,
         no_tmp_build_dir,
         keep_tmp_build_dir,
-        "class-" + "".join(random.choices(string.ascii_lowercase, k=5)),
+        "class-%d-%d" % (get_worker_index(), next(_CLASS_BUILD_COUNTER)),
     )
 
 
@@ -559,39 +622,33 @@ def min_mender_version(request, bitbake_variables):
         pytest.skip("Test requires Mender client %s or newer" % test_version)
 
 
-@pytest.fixture(autouse=True)
-def min_yocto_version(request, bitbake_variables):
-    version_mark = request.node.get_closest_marker("min_yocto_version")
-    if version_mark is None:
-        return
-
-    if request.config.getoption("--test-conversion"):
-        return
+YOCTO_VERSIONS_ORDERED = [
+    "krogoth",
+    "morty",
+    "pyro",
+    "rocko",
+    "sumo",
+    "thud",
+    "warrior",
+    "zeus",
+    "dunfell",
+    "gatesgarth",
+    "hardknott",
+    "honister",
+    "kirkstone",
+    # Keep this at the bottom.
+    "master",
+]
 
-    yocto_versions_ordered = [
-        "krogoth",
-        "morty",
-        "pyro",
-        "rocko",
-        "sumo",
-        "thud",
-        "warrior",
-        "zeus",
-        "dunfell",
-        "gatesgarth",
-        "hardknott",
-        "honister",
-        "kirkstone",
-        # Keep this at the bottom.
-        "master",
-    ]
 
-    test_version = version_mark.args[0]
+@pytest.fixture(scope="session")
+def current_yocto_version():
+    """Returns the Yocto branch we are testing, as deduced from git. This forks
+    git once per candidate branch, so do it only once per session."""
 
-    candidates = [
-        "'refs/heads/%s' 'refs/remotes/*/%s'" % (branch, branch)
-        for branch in yocto_versions_ordered
-    ]
+    candidates = []
+    for branch in YOCTO_VERSIONS_ORDERED:
+        candidates += ["refs/heads/%s" % branch, "refs/remotes/*/%s" % branch]
 
     # Technique taken from release_tool.py in integration repository:
 
@@ -603,25 +660,45 @@ def min_yocto_version(request, bitbake_variables):
 
     # An additional tweak here is that we only consider the well known branch
     # names from Yocto as candidates.
-    yocto_version = (
+    refs = (
         subprocess.check_output(
-            """
-        for i in $(git for-each-ref --format='%%(refname:short)' %s); do
-            echo $(git log --oneline $(git merge-base $i HEAD)..HEAD | wc -l) $i
-        done | sort -n | head -n1 | awk '{print $2}'
-        """
-            % " ".join(candidates),
-            shell=True,
+            ["git", "for-each-ref", "--format=%(refname:short)"] + candidates
         )
-        .strip()
         .decode()
+        .split()
     )
+    distances = []
+    for ref in refs:
+        # The commits in `ref..HEAD` are exactly those since the merge base.
+        count = subprocess.check_output(
+            ["git", "rev-list", "--count", "%s..HEAD" % ref]
+        )
+        distances.append((int(count), ref))
+    _, yocto_version = min(distances, default=(0, ""))
 
     # Get rid of remote information, if any.
     if yocto_version.rfind("/"):
         yocto_version = yocto_version[yocto_version.rfind("/") + 1 :]
 
-    if yocto_versions_ordered.index(test_version) > yocto_versions_ordered.index(
+    return yocto_version
+
+
+@pytest.fixture(autouse=True)
+def min_yocto_version(request, bitbake_variables, cli_opts):
+    version_mark = request.node.get_closest_marker("min_yocto_version")
+    if version_mark is None:
+        return
+
+    if cli_opts.conversion:
+        return
+
+    test_version = version_mark.args[0]
+
+    # Requested here rather than as an argument, so that git is only consulted
+    # if some test actually has the mark.
+    yocto_version = request.getfixturevalue("current_yocto_version")
+
+    if YOCTO_VERSIONS_ORDERED.index(test_version) > YOCTO_VERSIONS_ORDERED.index(
         yocto_version
     ):
         pytest.skip(
@@ -675,8 +752,28 @@ def not_for_machine(request, bitbake_variables):
             )
 
 
+@pytest.fixture(scope="session")
+def enabled_image_fstypes(bitbake_variables):
+    """Returns the set of image types enabled in the build. Computed once, since
+    the marker fixtures below check it for every test."""
+    return frozenset(
+        bitbake_variables.get("IMAGE_FSTYPES", "").split()
+        + [bitbake_variables.get("ARTIFACTIMG_FSTYPE", "")]
+    )
+
+
+@pytest.fixture(scope="session")
+def enabled_mender_features(bitbake_variables):
+    """Returns the set of enabled Mender features. For historical reasons this
+    also includes DISTRO_FEATURES."""
+    return frozenset(
+        bitbake_variables.get("MENDER_FEATURES", "").split()
+        + bitbake_variables.get("DISTRO_FEATURES", "").split()
+    )
+
+
 @pytest.fixture(autouse=True)
-def only_with_image(request, bitbake_variables):
+def only_with_image(request, enabled_image_fstypes):
     """Fixture that enables use of `only_with_image(img1, img2)` mark.
     Example::
 
@@ -689,17 +786,17 @@ def only_with_image(request, bitbake_variables):
     mark = request.node.get_closest_marker("only_with_image")
     if mark is not None:
         images = mark.args
-        current = bitbake_variables.get("IMAGE_FSTYPES", "").strip().split()
-        current.append(bitbake_variables.get("ARTIFACTIMG_FSTYPE", ""))
-        if not any([img in current for img in images]):
+        if not any([img in enabled_image_fstypes for img in images]):
             pytest.skip(
                 "no supported filesystem in {} "
-                "(supports {})".format(", ".join(current), ", ".join(images))
+                "(supports {})".format(
+                    ", ".join(sorted(enabled_image_fstypes)), ", ".join(images)
+                )
             )
 
 
 @pytest.fixture(autouse=True)
-def only_with_mender_feature(request, bitbake_variables):
+def only_with_mender_feature(request, enabled_mender_features):
     """Fixture that enables use of `only_with_mender_feature(feature1, feature2)` mark.
     Example::
 
@@ -717,18 +814,17 @@ def only_with_mender_feature(request, bitbake_variables):
 
     if mark is not None:
         features = mark.args
-        current = bitbake_variables.get("MENDER_FEATURES", "").strip().split()
-        # For historical reasons we also check in DISTRO_FEATURES.
-        current += bitbake_variables.get("DISTRO_FEATURES", "").strip().split()
-        if not all([feature in current for feature in features]):
+        if not all([feature in enabled_mender_features for feature in features]):
             pytest.skip(
                 "no supported distro feature in {} "
-                "(supports {})".format(", ".join(current), ", ".join(features))
+                "(supports {})".format(
+                    ", ".join(sorted(enabled_mender_features)), ", ".join(features)
+                )
             )
 
 
 @pytest.fixture(autouse=True)
-def not_with_mender_feature(request, bitbake_variables):
+def not_with_mender_feature(request, enabled_mender_features):
     """Fixture that enables use of `not_with_mender_feature(feature1, feature2)` mark.
     Example::
 
@@ -742,114 +838,148 @@ def not_with_mender_feature(request, bitbake_variables):
     mark = request.node.get_closest_marker("not_with_mender_feature")
     if mark is not None:
         features = mark.args
-        current = bitbake_variables.get("MENDER_FEATURES", "").strip().split()
-        # For historical reasons we also check in DISTRO_FEATURES.
-        current += bitbake_variables.get("DISTRO_FEATURES", "").strip().split()
-        if any([feature in current for feature in features]):
+        if any([feature in enabled_mender_features for feature in features]):
             pytest.skip(
                 "supported distro feature in {} "
-                "(excludes {})".format(", ".join(current), ", ".join(features))
+                "(excludes {})".format(
+                    ", ".join(sorted(enabled_mender_features)), ", ".join(features)
+                )
             )
 
 
 @pytest.fixture(scope="session")
-def host(request):
-    host, port = request.config.getoption("--host").split(":")
-    return "%s:%s" % (host, str(int(port) + get_worker_index()))
+def cli_opts(request):
+    """Returns all the command line options the fixtures in this module need,
+    read once per session."""
+    getoption = request.config.getoption
+    return types.SimpleNamespace(
+        host=getoption("--host"),
+        user=getoption("--user"),
+        ssh_priv_key=getoption("--ssh-priv-key"),
+        http_server=getoption("--http-server"),
+        board_type=getoption("--board-type"),
+        sdimg_location=getoption("--sdimg-location"),
+        qemu_wrapper=getoption("--qemu-wrapper"),
+        mender_image=getoption("--mender-image"),
+        bitbake_image=getoption("--bitbake-image"),
+        conversion=getoption("--test-conversion"),
+        use_s3=getoption("--use-s3"),
+        s3_address=getoption("--s3-address"),
+        no_tmp_build_dir=getoption("--no-tmp-build-dir"),
+        keep_tmp_build_dir=getoption("--keep-tmp-build-dir"),
+        test_variables=getoption("--test-variables"),
+        commercial_tests=getoption("--commercial-tests"),
+        collect_coverage=getoption("--collect-coverage"),
+        hardware_testing=getoption("--hardware-testing"),
+        no_cross_platform_tests=getoption("--no-cross-platform-tests"),
+        only_cross_platform_tests=getoption("--only-cross-platform-tests"),
+    )
+
+
+@pytest.fixture(scope="session")
+def host(cli_opts):
+    """Returns the (host, port) tuple to connect to. Every worker gets its own
+    port, counting up from the one given."""
+    host_info = cli_opts.host.split(":")
+
+    if len(host_info) == 2:
+        return host_info[0], int(host_info[1]) + get_worker_index()
+    elif len(host_info) == 1:
+        return host_info[0], 8822 + get_worker_index()
+    else:
+        return "localhost", 8822 + get_worker_index()
 
 
 @pytest.fixture(scope="session")
-def user(request):
-    return request.config.getoption("--user")
+def user(cli_opts):
+    return cli_opts.user
 
 
 @pytest.fixture(scope="session")
-def ssh_priv_key(request):
-    return request.config.getoption("--ssh-priv-key")
+def ssh_priv_key(cli_opts):
+    return cli_opts.ssh_priv_key
 
 
 @pytest.fixture(scope="session")
-def http_server(request):
-    if request.config.getoption("--http-server"):
+def http_server(cli_opts):
+    if cli_opts.http_server:
         if get_worker_count() > 1:
             raise RuntimeError(
                 "The --http-server argument is incompatible with multiple workers. Please use `-n 1` or disable xdist with `-p no:xdist`."
             )
-        return request.config.getoption("--http-server")
+        return cli_opts.http_server
     else:
         return "10.0.2.2:%d" % (8000 + get_worker_index())
 
 
 @pytest.fixture(scope="session")
-def board_type(request):
-    return request.config.getoption("--board-type")
+def board_type(cli_opts):
+    return cli_opts.board_type
 
 
 @pytest.fixture(scope="session")
-def sdimg_location(request):
-    return request.config.getoption("--sdimg-location")
+def sdimg_location(cli_opts):
+    return cli_opts.sdimg_location
 
 
 @pytest.fixture(scope="session")
-def qemu_wrapper(request):
-    return request.config.getoption("--qemu-wrapper")
+def qemu_wrapper(cli_opts):
+    return cli_opts.qemu_wrapper
 
 
 @pytest.fixture(scope="session")
-def mender_image(request):
-    return request.config.getoption("--mender-image")
+def mender_image(cli_opts):
+    return cli_opts.mender_image
 
 
 @pytest.fixture(scope="session")
-def bitbake_image(request):
-    return request.config.getoption("--bitbake-image")
+def bitbake_image(cli_opts):
+    return cli_opts.bitbake_image
 
 
 @pytest.fixture(scope="session")
-def conversion(request):
-    return request.config.getoption("--test-conversion")
+def conversion(cli_opts):
+    return cli_opts.conversion
 
 
 @pytest.fixture(scope="session")
-def use_s3(request):
-    return request.config.getoption("--use-s3")
+def use_s3(cli_opts):
+    return cli_opts.use_s3
 
 
 @pytest.fixture(scope="session")
-def s3_address(request):
-    return request.config.getoption("--s3-address")
+def s3_address(cli_opts):
+    return cli_opts.s3_address
 
 
 @pytest.fixture(scope="session")
-def no_tmp_build_dir(request):
-    return request.config.getoption("--no-tmp-build-dir")
+def no_tmp_build_dir(cli_opts):
+    return cli_opts.no_tmp_build_dir
 
 
 @pytest.fixture(scope="session")
-def keep_tmp_build_dir(request):
-    return request.config.getoption("--keep-tmp-build-dir")
+def keep_tmp_build_dir(cli_opts):
+    return cli_opts.keep_tmp_build_dir
 
 
 @pytest.fixture(scope="session")
-def test_variables(request):
-    return request.config.getoption("--test-variables")
+def test_variables(cli_opts):
+    return cli_opts.test_variables
 
 
 @pytest.fixture(autouse=True)
-def commercial_test(request, bitbake_variables):
+def commercial_test(request, bitbake_variables, cli_opts):
     mark = request.node.get_closest_marker("commercial")
-    if mark is not None and not request.config.getoption("--commercial-tests"):
+    if mark is not None and not cli_opts.commercial_tests:
         pytest.skip("Tests of commercial features are disabled.")
 
 
 @pytest.fixture(scope="function", autouse=True)
-def cross_platform_test(request):
+def cross_platform_test(request, cli_opts):
     mark = request.node.get_closest_marker("cross_platform")
-    option_no = request.config.getoption("--no-cross-platform-tests")
-    option_only = request.config.getoption("--only-cross-platform-tests")
-    if mark and option_no:
+    if mark and cli_opts.no_cross_platform_tests:
         pytest.skip("Not running cross-platform tests.")
-    if not mark and option_only:
+    if not mark and cli_opts.only_cross_platform_tests:
         pytest.skip("Running only cross-platform tests.")
 
 
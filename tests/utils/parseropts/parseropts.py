@@ -118,6 +118,14 @@ def pytest_addoption(parser):
         default=False,
         help="Run the test with real hardware",
     )
+    parser.addoption(
+        "--collect-coverage",
+        action="store_true",
+        default=os.environ.get("MENDER_COLLECT_COVERAGE", "0") not in ["", "0"],
+        help="""Collect the coverage files in /data/mender/ from the device after
+                     every test. Also enabled by setting MENDER_COLLECT_COVERAGE=1
+                     in the environment.""",
+    )
     parser.addoption(
         "--no-cross-platform-tests",
         action="store_true",